@@ -1,13 +1,25 @@
 import os
-import json
+import time
+import asyncio
 import httpx
+import orjson
 import logging
+import tempfile
+import threading
+from contextlib import asynccontextmanager
+from operator import attrgetter
 from fastapi import FastAPI, Request
 from fastapi.responses import StreamingResponse
 from google import genai
-from fastapi.responses import JSONResponse
+from fastapi.responses import JSONResponse, Response
 
 CACHE_FILE = "gemini_models_cache.json"
+
+# --- In-memory models cache (pre-serialized /v1/models payload) ---
+_MODELS_TTL = 3600
+_MODELS_CACHE: bytes | None = None
+_MODELS_CACHE_EXPIRY: float = 0.0
+_cache_mtime: float = 0.0
 # --- Setup Logging ---
 logging.basicConfig(
     level=logging.INFO,
@@ -20,86 +32,263 @@ OPENROUTER_API_KEY = os.getenv("OPENROUTER_API_KEY")
 OPENROUTER_BASE_URL = os.getenv("OPENROUTER_BASE_URL")
 GEMINI_API_KEY = os.getenv("GEMINI_API_KEY")
 
+# OpenRouter endpoints and auth headers never change for the life of the process
+_OR_MODELS_URL = f"{OPENROUTER_BASE_URL}/models"
+_OR_CHAT_URL = f"{OPENROUTER_BASE_URL}/chat/completions"
+_OR_HEADERS = {"Authorization": f"Bearer {OPENROUTER_API_KEY}"}
+_OR_HEADERS_JSON = {**_OR_HEADERS, "Content-Type": "application/json"}
+
 # Initialize Google GenAI client if key exists
 genai_client = genai.Client(api_key=GEMINI_API_KEY) if GEMINI_API_KEY else None
 
-app = FastAPI()
-client = httpx.AsyncClient(timeout=None)
+# Shared by every mapped Gemini model; only ever serialized, never mutated
+_GEMINI_ARCHITECTURE = {
+    "modality": "text->text",
+    "input_modalities": ["text"],
+    "output_modalities": ["text"],
+    "tokenizer": "Gemini",
+    "instruct_type": None
+}
+
+# Gemini model attributes mapped into each /v1/models entry
+_get_model_fields = attrgetter("name", "display_name", "description", "input_token_limit", "output_token_limit")
+
+# Pre-encoded SSE envelope for Gemini chunks; only the JSON-escaped delta text varies
+_CHUNK_PREFIX = b'data: {"id":"chatcmpl-gemini","object":"chat.completion.chunk","choices":[{"delta":{"content":'
+_CHUNK_SUFFIX = b'},"index":0,"finish_reason":null}]}\n\n'
+_DONE = b"data: [DONE]\n\n"
+
+# Gemini SSE frames are buffered for at most this long / this many bytes before flushing
+_COALESCE_WINDOW = 0.005
+_COALESCE_MAX_BYTES = 4096
+
+# OpenAI -> Gemini message roles; anything else maps to "system"
+_ROLE_MAP = {"user": "user", "assistant": "model"}
+
+# Gemini events buffered between the SDK worker thread and the response; bounds memory for slow clients
+_STREAM_QUEUE_SIZE = 64
+
+# Marks the end of a stream pumped from a worker thread
+_SENTINEL = object()
+
+
+def _set_models_cache(data: dict, mtime: float = 0.0) -> bytes:
+    """Serialize the models payload once and keep it in memory until the TTL expires."""
+    global _MODELS_CACHE, _MODELS_CACHE_EXPIRY, _cache_mtime
+    _MODELS_CACHE = orjson.dumps(data)
+    _MODELS_CACHE_EXPIRY = time.monotonic() + _MODELS_TTL
+    _cache_mtime = mtime
+    return _MODELS_CACHE
+
+
+def _err_frame(msg: str) -> bytes:
+    """Encode an error as a single SSE frame."""
+    return b'data: {"error":' + orjson.dumps(msg) + b'}\n\n'
+
+
+def _renew_models_cache():
+    """Extend the TTL of the in-memory models cache without re-reading it."""
+    global _MODELS_CACHE_EXPIRY
+    _MODELS_CACHE_EXPIRY = time.monotonic() + _MODELS_TTL
+
+
+def _expire_models_cache():
+    """Drop the in-memory models cache so the next request refreshes it."""
+    global _MODELS_CACHE, _MODELS_CACHE_EXPIRY, _cache_mtime
+    _MODELS_CACHE = None
+    _MODELS_CACHE_EXPIRY = 0.0
+    _cache_mtime = 0.0
+
+
+def _load_cache_sync():
+    with open(CACHE_FILE, "rb") as f:
+        mtime = os.fstat(f.fileno()).st_mtime
+        return orjson.loads(f.read()), mtime
+
+
+def _list_gemini_models_sync():
+    return list(genai_client.models.list())
+
+
+def _pump_stream(loop, queue, stop, make_stream):
+    """Drain a blocking SDK stream on a worker thread into an asyncio queue.
+
+    Each put waits for room in the queue, so a slow consumer pauses the
+    upstream read. Errors are forwarded through the queue; the stream ends
+    with _SENTINEL unless the consumer has already set stop.
+    """
+    def put(item):
+        asyncio.run_coroutine_threadsafe(queue.put(item), loop).result()
+
+    try:
+        for event in make_stream():
+            if stop.is_set():
+                return
+            put(event)
+    except Exception as e:
+        if not stop.is_set():
+            put(e)
+        return
+    if not stop.is_set():
+        put(_SENTINEL)
+
+
+def _model_fields(m) -> tuple:
+    """Read the attributes mapped for /v1/models, defaulting any the SDK object lacks."""
+    try:
+        name, display_name, description, input_limit, output_limit = _get_model_fields(m)
+    except AttributeError:
+        slug = m.name.removeprefix("models/")
+        display_name = getattr(m, "display_name", slug)
+        description = getattr(m, "description", "")
+        input_limit = getattr(m, "input_token_limit", 4096)
+        output_limit = getattr(m, "output_token_limit", 4096)
+    else:
+        slug = name.removeprefix("models/")
+    # Not a field on current SDK models, so it stays a defaulted lookup outside the fast path
+    methods = getattr(m, "supported_generation_methods", [])
+    return slug, display_name, description, input_limit, output_limit, methods
+
+
+def _atomic_write(path: str, data: bytes) -> float:
+    """Write to a temp file and rename it over path so readers never see partial JSON."""
+    # A unique temp name per writer keeps concurrent refreshes from clobbering each other
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path) or ".", suffix=".tmp")
+    try:
+        with os.fdopen(fd, "wb") as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+    except BaseException:
+        try:
+            os.unlink(tmp_path)
+        except OSError:
+            pass
+        raise
+    return os.stat(path).st_mtime
+
+
+async def warm_models_cache():
+    """Load the on-disk models cache into memory once at startup."""
+    try:
+        cached_data, mtime = await asyncio.to_thread(_load_cache_sync)
+        _set_models_cache(cached_data, mtime)
+        logger.info(f"📂 Warmed in-memory cache with {len(cached_data['data'])} models")
+    except FileNotFoundError:
+        return
+    except Exception as e:
+        logger.warning(f"⚠️ Failed to warm models cache: {e}")
+
+
+async def warm_http_pool(http: httpx.AsyncClient):
+    """Open a connection to OpenRouter ahead of the first request so it skips the TCP/TLS handshake."""
+    if genai_client or not OPENROUTER_BASE_URL:
+        return
+    try:
+        await http.head(_OR_MODELS_URL, headers=_OR_HEADERS, timeout=5.0)
+        logger.info("🔌 Pre-warmed OpenRouter connection pool")
+    except Exception as e:
+        logger.warning(f"⚠️ Failed to pre-warm OpenRouter connection: {e}")
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """Own the upstream HTTP client: build and warm it on startup, drain it on shutdown."""
+    await warm_models_cache()
+    app.state.http = httpx.AsyncClient(
+        http2=True,
+        timeout=httpx.Timeout(connect=5.0, read=None, write=30.0, pool=5.0),
+        limits=httpx.Limits(max_connections=1000, max_keepalive_connections=200, keepalive_expiry=60.0),
+    )
+    await warm_http_pool(app.state.http)
+    try:
+        yield
+    finally:
+        await app.state.http.aclose()
+
+
+app = FastAPI(lifespan=lifespan)
+
 
 @app.get("/v1/models")
 async def list_models():
     """List models from Gemini if available, else from OpenRouter."""
     logger.info("📡 GET /v1/models called")
 
-    # --- check if cache exists ---
-    if os.path.exists(CACHE_FILE):
+    # --- serve from memory while fresh ---
+    if _MODELS_CACHE and time.monotonic() < _MODELS_CACHE_EXPIRY:
+        return Response(content=_MODELS_CACHE, media_type="application/json")
+
+    # --- check if cache exists and whether it changed since it was last read ---
+    try:
+        st = await asyncio.to_thread(os.stat, CACHE_FILE)
+    except OSError:
+        st = None
+
+    if st and _MODELS_CACHE and st.st_mtime == _cache_mtime:
+        _renew_models_cache()
+        return Response(content=_MODELS_CACHE, media_type="application/json")
+
+    if st:
         try:
-            with open(CACHE_FILE, "r", encoding="utf-8") as f:
-                cached_data = json.load(f)
-                logger.info(f"📂 Loaded {len(cached_data['data'])} models from cache")
-                return JSONResponse(content=cached_data, status_code=200)
+            cached_data, mtime = await asyncio.to_thread(_load_cache_sync)
+            logger.info(f"📂 Loaded {len(cached_data['data'])} models from cache")
+            return Response(content=_set_models_cache(cached_data, mtime), media_type="application/json")
         except Exception as e:
+            _expire_models_cache()
             logger.warning(f"⚠️ Failed to load cache: {e}, falling back to live fetch")
 
     # --- fetch from Gemini ---
     if genai_client:
         try:
             logger.info("Using Gemini client to list models...")
-            models = genai_client.models.list()
-            mapped_models = []
-
-            for m in models:
-                canonical_slug = m.name.replace("models/", "")
-                mapped_models.append({
-                    "id": canonical_slug,
-                    "canonical_slug": canonical_slug,
-                    "name": getattr(m, "display_name", canonical_slug),
+            models = await asyncio.to_thread(_list_gemini_models_sync)
+            mapped_models = [
+                {
+                    "id": slug,
+                    "canonical_slug": slug,
+                    "name": display_name,
                     "created": 0,
-                    "description": getattr(m, "description", ""),
-                    "context_length": getattr(m, "input_token_limit", 4096),
-                    "architecture": {
-                        "modality": "text->text",
-                        "input_modalities": ["text"],
-                        "output_modalities": ["text"],
-                        "tokenizer": "Gemini",
-                        "instruct_type": None
-                    },
+                    "description": description,
+                    "context_length": input_limit,
+                    "architecture": _GEMINI_ARCHITECTURE,
                     "top_provider": {
-                        "context_length": getattr(m, "input_token_limit", 4096),
-                        "max_completion_tokens": getattr(m, "output_token_limit", 4096),
+                        "context_length": input_limit,
+                        "max_completion_tokens": output_limit,
                         "is_moderated": False
                     },
                     "per_request_limits": None,
-                    "supported_parameters": getattr(m, "supported_generation_methods", [])
-                })
+                    "supported_parameters": methods
+                }
+                for slug, display_name, description, input_limit, output_limit, methods in map(_model_fields, models)
+            ]
 
             response_data = {"object": "list", "data": mapped_models}
 
             # --- save to cache ---
+            mtime = 0.0
             try:
-                with open(CACHE_FILE, "w", encoding="utf-8") as f:
-                    json.dump(response_data, f, ensure_ascii=False, indent=2)
+                mtime = await asyncio.to_thread(
+                    _atomic_write, CACHE_FILE, orjson.dumps(response_data, option=orjson.OPT_INDENT_2)
+                )
                 logger.info(f"💾 Cached {len(mapped_models)} models to {CACHE_FILE}")
             except Exception as e:
                 logger.warning(f"⚠️ Failed to write cache: {e}")
 
             logger.info(f"✅ Retrieved {len(mapped_models)} models from Gemini")
-            return JSONResponse(content=response_data, status_code=200)
+            return Response(content=_set_models_cache(response_data, mtime), media_type="application/json")
 
         except Exception as e:
+            _expire_models_cache()
             logger.error(f"❌ Gemini model list failed: {e}", exc_info=True)
             return JSONResponse(content={"error": str(e)}, status_code=500)
 
     # --- fallback: OpenRouter ---
     try:
         logger.info("Using OpenRouter to list models...")
-        url = f"{OPENROUTER_BASE_URL}/models"
-        headers = {"Authorization": f"Bearer {OPENROUTER_API_KEY}"}
-        r = await client.get(url, headers=headers)
-        data = r.json()
-        filtered = data.get("data", [])
-        logger.info(f"✅ Retrieved {len(filtered)} models from OpenRouter")
-        return JSONResponse(content={"object": "list", "data": filtered}, status_code=r.status_code)
+        r = await app.state.http.get(_OR_MODELS_URL, headers=_OR_HEADERS)
+        # Upstream already returns an OpenAI-style model list; forward it untouched
+        logger.info(f"✅ Retrieved {len(r.content)} bytes of models from OpenRouter")
+        return Response(content=r.content, media_type="application/json", status_code=r.status_code)
     except Exception as e:
         logger.error(f"❌ OpenRouter model list failed: {e}", exc_info=True)
         return JSONResponse(content={"error": str(e)}, status_code=500)
@@ -108,15 +297,12 @@ async def list_models():
 def convert_openai_messages_to_gemini_contents(messages: list):
     """Convert OpenAI-style messages to Gemini contents format."""
     gemini_contents = []
+    append = gemini_contents.append
     for msg in messages:
-        role = msg.get("role")
-        text = msg.get("content", "")
+        text = msg.get("content")
         if not text:
             continue
-        gemini_contents.append({
-            "role": "user" if role == "user" else ("model" if role == "assistant" else "system"),
-            "parts": [{"text": text}]
-        })
+        append({"role": _ROLE_MAP.get(msg.get("role"), "system"), "parts": [{"text": text}]})
     return gemini_contents
 
 @app.post("/v1/chat/completions")
@@ -125,8 +311,10 @@ async def chat_completions(request: Request):
     logger.info("📡 POST /v1/chat/completions called")
 
     try:
-        body = await request.json()
-        logger.debug(f"Request body: {json.dumps(body, indent=2)}")
+        raw = await request.body()
+        body = orjson.loads(raw)
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("Request body: %s", raw.decode(errors="replace"))
     except Exception as e:
         logger.error(f"❌ Failed to parse JSON body: {e}")
         return JSONResponse(content={"error": "Invalid JSON body"}, status_code=400)
@@ -141,36 +329,68 @@ async def chat_completions(request: Request):
 
             if isinstance(contents, list) and isinstance(contents[0], dict):
                 contents = convert_openai_messages_to_gemini_contents(contents)
+
             async def gemini_event_generator():
+                queue = asyncio.Queue(maxsize=_STREAM_QUEUE_SIZE)
+                stop = threading.Event()
+                # Frames arriving close together are coalesced into a single write
+                buf = bytearray()
+                flush_at = 0.0
                 try:
                     logger.info(f"🔄 Streaming response from Gemini model: {model}")
 
-                    stream = genai_client.models.generate_content_stream(
-                        model=model,
-                        contents=contents,
-                    )
-                    for event in stream:
-                        if hasattr(event, "text"):
-                            chunk = {
-                                "id": "chatcmpl-gemini",
-                                "object": "chat.completion.chunk",
-                                "choices": [
-                                    {
-                                        "delta": {"content": event.text},
-                                        "index": 0,
-                                        "finish_reason": None,
-                                    }
-                                ]
-                            }
-                            yield f"data: {json.dumps(chunk)}\n\n"
-
-                    yield "data: [DONE]\n\n"
+                    threading.Thread(
+                        target=_pump_stream,
+                        args=(
+                            asyncio.get_running_loop(),
+                            queue,
+                            stop,
+                            lambda: genai_client.models.generate_content_stream(
+                                model=model,
+                                contents=contents,
+                            ),
+                        ),
+                        daemon=True,
+                    ).start()
+
+                    while True:
+                        if buf:
+                            try:
+                                event = await asyncio.wait_for(queue.get(), max(flush_at - time.monotonic(), 0.0))
+                            except asyncio.TimeoutError:
+                                yield bytes(buf)
+                                buf.clear()
+                                continue
+                        else:
+                            event = await queue.get()
+
+                        if event is _SENTINEL:
+                            break
+                        if isinstance(event, Exception):
+                            raise event
+                        text = getattr(event, "text", None)
+                        if text is not None:
+                            if not buf:
+                                flush_at = time.monotonic() + _COALESCE_WINDOW
+                            buf += _CHUNK_PREFIX + orjson.dumps(text) + _CHUNK_SUFFIX
+                            if len(buf) >= _COALESCE_MAX_BYTES:
+                                yield bytes(buf)
+                                buf.clear()
+
+                    if buf:
+                        yield bytes(buf)
+                    yield _DONE
                     logger.info("✅ Gemini stream completed")
 
                 except Exception as e:
                     logger.error(f"❌ Gemini streaming failed: {e}", exc_info=True)
-                    yield f"data: {json.dumps({'error': str(e)})}\n\n"
-                    yield "data: [DONE]\n\n"
+                    yield bytes(buf) + _err_frame(str(e))
+                    yield _DONE
+                finally:
+                    # Free a slot in case the pump is blocked on a full queue, so it can see stop and exit
+                    stop.set()
+                    while not queue.empty():
+                        queue.get_nowait()
 
             return StreamingResponse(gemini_event_generator(), media_type="text/event-stream")
 
@@ -179,29 +399,33 @@ async def chat_completions(request: Request):
             return JSONResponse(content={"error": str(e)}, status_code=500)
 
     # --- fallback: OpenRouter (streaming mode) ---
-    url = f"{OPENROUTER_BASE_URL}/chat/completions"
-    headers = {
-        "Authorization": f"Bearer {OPENROUTER_API_KEY}",
-        "Content-Type": "application/json",
-    }
-
-    body["stream"] = True
+    # Forward the client's bytes untouched when it already asked for a stream
+    if body.get("stream") is True:
+        payload = raw
+    else:
+        body["stream"] = True
+        payload = orjson.dumps(body)
 
     async def event_generator():
         try:
             logger.info(f"🔄 Streaming response from OpenRouter model: {body.get('model')}")
-            async with client.stream("POST", url, headers=headers, json=body) as r:
-                async for line in r.aiter_lines():
-                    if not line:
-                        continue
-                    logger.debug(f"OpenRouter chunk: {line[:50]}...")
-                    yield line + "\n\n"
+            async with app.state.http.stream("POST", _OR_CHAT_URL, headers=_OR_HEADERS_JSON, content=payload) as r:
+                if not r.is_success:
+                    await r.aread()
+                    logger.error(f"❌ OpenRouter returned {r.status_code}: {r.text}")
+                    yield _err_frame(f"Upstream error {r.status_code}: {r.text}")
+                    yield _DONE
+                    return
+                # Upstream already frames SSE events and sends its own [DONE]
+                debug = logger.isEnabledFor(logging.DEBUG)
+                async for chunk in r.aiter_bytes():
+                    if debug:
+                        logger.debug("OpenRouter chunk: %s...", chunk[:50].decode(errors="replace"))
+                    yield chunk
                 logger.info("✅ OpenRouter stream completed")
-                yield "data: [DONE]\n\n"
         except Exception as e:
             logger.error(f"❌ OpenRouter streaming failed: {e}", exc_info=True)
-            err = {"error": f"Streaming failed: {str(e)}"}
-            yield f"data: {json.dumps(err)}\n\n"
-            yield "data: [DONE]\n\n"
+            yield _err_frame(f"Streaming failed: {str(e)}")
+            yield _DONE
 
     return StreamingResponse(event_generator(), media_type="text/event-stream")